@@ -6,28 +6,302 @@ Author: HendyTurtle =)
 
 import os
 import sys
-import json
 import base64
 import asyncio
 import hashlib
+import json
 import re
 import time
+import functools
+import importlib.util
+import threading
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Deque, Dict, List, Optional, Any, Tuple
 from io import BytesIO
 
 try:
-    from patchright.async_api import async_playwright, Page, Browser, TimeoutError as PlaywrightTimeout
-    from openai import AsyncOpenAI
+    from patchright.async_api import async_playwright, Page, Browser, BrowserContext, TimeoutError as PlaywrightTimeout
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient, BadRequestError, UnprocessableEntityError
+    import httpx
     from dotenv import load_dotenv
     from PIL import Image
+    import orjson
 except ImportError:
     print("Error: Missing dependencies, run:")
-    print("pip install patchright openai python-dotenv Pillow")
+    print("pip install patchright openai python-dotenv Pillow orjson")
     print("patchright install chromium")
     sys.exit(1)
 
 
+# LLM 回复解析
+_JSON_FENCE_START = re.compile(r'^```json\s*')
+_JSON_FENCE_END = re.compile(r'\s*```$')
+_JSON_OBJ = re.compile(r'\{.*\}', re.DOTALL)
+# 流式输出时边收边显示 thought
+_THOUGHT_START = re.compile(r'"thought"\s*:\s*"')
+_JSON_STR_BODY = re.compile(r'(?:[^"\\]|\\.)*')
+_THOUGHT_ECHO_LIMIT = 70
+
+# 每步发给 LLM 的元素数和页面文本长度，在页面里就截断好
+_ELEMENT_LIMIT = 40
+_TEXT_LIMIT = 800
+
+# 截图超过这个大小才用 PIL 缩小重新编码
+_SCREENSHOT_MAX_BYTES = 150 * 1024
+
+
+# 劫持所有可能打开新标签页的方式，强制在当前页打开
+_TARGET_HIJACK_JS = '''
+(() => {
+    // 1. 劫持 window.open，强制在当前窗口打开
+    const originalOpen = window.open;
+    window.open = function(url, target, features) {
+        if (url) {
+            window.location.href = url;
+        }
+        return window;
+    };
+
+    // 2. 劫持所有带 target 的链接，改为在当前页打开
+    const TARGET_SELECTOR = 'a[target], form[target]';
+
+    function fixTarget(el) {
+        const original = el.getAttribute('target');
+        if (original && !['_self', '_top'].includes(original)) {
+            el.removeAttribute('target');
+            el.setAttribute('data-original-target', original);
+        }
+    }
+
+    function fixTargetElements(root) {
+        // 处理链接和表单
+        root.querySelectorAll && root.querySelectorAll(TARGET_SELECTOR).forEach(fixTarget);
+
+        // 处理 base 标签的 target
+        const base = document.querySelector('base[target]');
+        if (base) {
+            base.removeAttribute('target');
+        }
+    }
+
+    // 3. 监听点击事件，拦截新窗口打开
+    document.addEventListener('click', (e) => {
+        const el = e.target.closest('a[target]');
+        if (el) {
+            const target = el.getAttribute('target');
+            if (target && !['_self', '_top'].includes(target)) {
+                e.preventDefault();
+                const href = el.getAttribute('href');
+                if (href) {
+                    window.location.href = href;
+                }
+            }
+        }
+    }, true);
+
+    // 4. 劫持表单提交，防止新窗口
+    document.addEventListener('submit', (e) => {
+        const form = e.target;
+        const target = form.getAttribute('target');
+        if (target && !['_self', '_top'].includes(target)) {
+            form.removeAttribute('target');
+        }
+    }, true);
+
+    // 5. 处理当前页面已有的元素
+    fixTargetElements(document);
+
+    // 6. 监听新添加的元素，50ms 内的变动合并处理
+    const seen = new WeakSet();
+    let pending = [];
+    let flushTimer = null;
+
+    function flushPending() {
+        flushTimer = null;
+        const nodes = pending;
+        pending = [];
+        for (const node of nodes) {
+            // 有子元素的节点总是重新扫描（子树可能在脱离期间变过）
+            if (!node.isConnected || (seen.has(node) && !node.firstElementChild)) continue;
+            seen.add(node);
+            if (node.tagName === 'BASE' && node.target) {
+                node.removeAttribute('target');
+            }
+            if (node.matches && node.matches(TARGET_SELECTOR)) {
+                fixTarget(node);
+            }
+            // 只有带子元素的节点才需要扫描子树
+            if (node.firstElementChild) {
+                fixTargetElements(node);
+            }
+        }
+    }
+
+    const observer = new MutationObserver(mutations => {
+        for (const mutation of mutations) {
+            for (const node of mutation.addedNodes) {
+                if (node.nodeType === Node.ELEMENT_NODE) {
+                    pending.push(node);
+                }
+            }
+            // 移除的节点可能被重新插入（SPA 重渲染、portal），到时要重新处理
+            for (const node of mutation.removedNodes) {
+                seen.delete(node);
+            }
+        }
+        if (pending.length && flushTimer === null) {
+            flushTimer = setTimeout(flushPending, 50);
+        }
+    });
+    observer.observe(document, { childList: true, subtree: true });
+
+    // 7. 劫持其他打开新窗口的方式
+    // 防止使用 <area target="...">
+    if (window.HTMLAreaElement) {
+        const areaDesc = Object.getOwnPropertyDescriptor(HTMLAreaElement.prototype, 'target');
+        if (areaDesc) {
+            Object.defineProperty(HTMLAreaElement.prototype, 'target', {
+                get: areaDesc.get,
+                set: function(val) {
+                    if (val && !['_self', '_top'].includes(val)) {
+                        val = '_self';
+                    }
+                    return areaDesc.set.call(this, val);
+                }
+            });
+        }
+    }
+})();
+'''
+
+
+def _install_light_stack_capture():
+    """
+    Patchright 每次 API 调用都会遍历 Python 调用栈，记录调用位置供 trace 使用，
+    这里换成只取 API 名（报错信息里要用）的轻量版本
+    """
+    import importlib
+    import patchright
+    
+    internal_path = str(Path(patchright.__file__).parent)
+    mapping_file = str(Path(internal_path) / '_impl' / '_impl_to_api_mapping.py')
+    
+    def capture() -> Dict[str, Any]:
+        frame = sys._getframe(2)
+        api_name = ''
+        while frame:
+            filename = frame.f_code.co_filename
+            if filename == mapping_file:
+                pass
+            elif filename.startswith(internal_path):
+                api_name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+            elif api_name:
+                break
+            frame = frame.f_back
+        return {'frames': [], 'apiName': api_name, 'title': None}
+    
+    # Modules that imported the function by name need patching too
+    for name in ('_connection', '_network', '_disposable'):
+        try:
+            module = importlib.import_module(f'patchright._impl.{name}')
+        except ImportError:
+            continue
+        if hasattr(module, '_capture_stack_trace'):
+            module._capture_stack_trace = capture
+
+
+def _partial_json_string(raw: str) -> str:
+    """Decoded part of a JSON string value that may still be streaming in"""
+    body = _JSON_STR_BODY.match(raw).group(0)
+    # A trailing escape can be cut in half (e.g. \u4e), retry without it
+    for end in (len(body), body.rfind('\\')):
+        if end < 0:
+            break
+        try:
+            return json.loads('"' + body[:end] + '"')
+        except ValueError:
+            continue
+    return ''
+
+
+def _draft_size(size: Tuple[int, int], max_dim: int) -> Tuple[int, int]:
+    """
+    Image.draft() request with the image's aspect ratio: Pillow picks the
+    DCT scale from min(w // req_w, h // req_h), so a square request never
+    shrinks a landscape screenshot
+    """
+    w, h = size
+    if w >= h:
+        return max_dim, max(1, round(h * max_dim / w))
+    return max(1, round(w * max_dim / h)), max_dim
+
+
+def _downscale_jpeg(data: bytes, max_dim: int = 1024) -> bytes:
+    """Shrink a JPEG to max_dim on its longer side and re-encode it"""
+    img = Image.open(BytesIO(data))
+    
+    # Zoom: let libjpeg downscale while decoding, LANCZOS only for the rest
+    img.draft('RGB', _draft_size(img.size, max_dim))
+    if max(img.size) > max_dim:
+        ratio = max_dim / max(img.size)
+        img = img.resize((int(img.width * ratio), int(img.height * ratio)), Image.Resampling.LANCZOS)
+    
+    # optimize=True costs far more encode time than the bytes it saves
+    buf = BytesIO()
+    img.save(buf, format='JPEG', quality=40, progressive=False, subsampling=2)
+    return buf.getvalue()
+
+
+def _write_lines(lines: List[str]):
+    """Write a block of output lines with a single write + flush"""
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
+
+
+def _dumps(obj: Any) -> str:
+    """JSON string via orjson, non-ASCII kept as is like ensure_ascii=False"""
+    try:
+        return orjson.dumps(obj).decode()
+    except TypeError:
+        # e.g. integers beyond 64 bits, which the model may well emit
+        return json.dumps(obj, ensure_ascii=False)
+
+
+def _with_locator(handler):
+    """Element action handlers: resolve action['index'] to a locator first"""
+    @functools.wraps(handler)
+    async def wrapper(self, action: Dict) -> Dict[str, Any]:
+        index = action.get('index')
+        locator = self._get_element_locator(index)
+        if not locator:
+            return {'success': False, 'message': f'元素 {index} 不存在'}
+        try:
+            return await handler(self, action, index, locator)
+        except PlaywrightTimeout:
+            # No count() check up front, a missing element shows up as a timeout
+            return {'success': False, 'message': f'元素 {index} 不存在或不可操作'}
+    return wrapper
+
+
+@functools.lru_cache(maxsize=8)
+def _get_openai_client(api_base: str, api_key: str, timeout: float) -> AsyncOpenAI:
+    """Share one client (and its connection pool) per endpoint across agents"""
+    # Keep the connection warm between steps (LLM calls can be >5s apart),
+    # HTTP/2 only when h2 is installed (pip install httpx[http2])
+    http_client = DefaultAsyncHttpxClient(
+        http2=importlib.util.find_spec('h2') is not None,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=4, keepalive_expiry=120),
+        timeout=timeout
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=api_base,
+        timeout=timeout,
+        http_client=http_client
+    )
+
+
 class Style:
     """极简 ANSI 样式工具"""
     RESET = '\033[0m'
@@ -54,6 +328,20 @@ class Style:
     BG_CYAN = '\033[46m'
     BG_WHITE = '\033[47m'
     
+    # 预先拼好的常用组合
+    _BOLD_BLUE = BOLD + BLUE
+    _BOLD_WHITE = BOLD + WHITE
+    _STEP = BOLD + BLUE + 'Step' + RESET
+    
+    # 每步都会打印的标签
+    LBL_URL = BOLD + BLUE + 'URL' + RESET
+    LBL_ELEMS = BOLD + GREEN + 'Elements' + RESET
+    LBL_WARNING = BOLD + YELLOW + 'Warning' + RESET
+    LBL_THINK = BOLD + MAGENTA + 'Think' + RESET
+    LBL_ERROR = BOLD + RED + 'Error' + RESET
+    LBL_OK = BOLD + GREEN + 'OK' + RESET
+    LBL_FAIL = BOLD + RED + 'Fail' + RESET
+    
     @classmethod
     def text(cls, s: str, *codes: str) -> str:
         """给文本添加颜色/样式"""
@@ -64,31 +352,109 @@ class Style:
     @classmethod
     def header(cls, s: str, color: str = CYAN) -> str:
         """大标题"""
-        return f"\n{cls.text(s, cls.BOLD, color)}"
+        return f"\n{cls.BOLD}{color}{s}{cls.RESET}"
     
     @classmethod
     def label(cls, text: str, color: str = BLUE) -> str:
         """标签样式，无方括号"""
-        return cls.text(text, cls.BOLD, color)
+        return cls.BOLD + color + text + cls.RESET
     
     @classmethod
     def dim(cls, s: str) -> str:
-        return cls.text(s, cls.DIM)
+        return cls.DIM + s + cls.RESET
     
     @classmethod
     def step(cls, current: int) -> str:
         """步骤显示，只显示当前步数"""
-        return f"\n{cls.text('Step', cls.BOLD, cls.BLUE)} {cls.text(str(current), cls.BOLD, cls.WHITE)}"
+        return f"\n{cls._STEP} {cls._BOLD_WHITE}{current}{cls.RESET}"
     
     @classmethod
     def action(cls, action_type: str, details: str = "") -> str:
         """操作显示"""
-        badge = cls.text(action_type.upper(), cls.BOLD, cls.BLUE)
+        badge = cls._BOLD_BLUE + action_type.upper() + cls.RESET
         if details:
             return f"{badge}  {cls.dim(details)}"
         return badge
 
 
+def _estimate_tokens(content: Any) -> int:
+    """粗略估算 token 数：中文约 1 字 1 token，ASCII 约 4 字符 1 token"""
+    if isinstance(content, list):
+        # 多模态消息，detail=low 的图片固定 85 tokens
+        return sum(
+            85 if part.get('type') == 'image_url' else _estimate_tokens(part.get('text', ''))
+            for part in content
+        )
+    chars = len(content)
+    wide = (len(content.encode('utf-8')) - chars) // 2
+    return wide + (chars - wide) // 4 + 4
+
+
+class PromptManager:
+    """
+    对话消息组装：system + 任务 + 已提交的历史构成字节稳定的前缀，
+    每步的页面状态放在末尾的动态消息里，每次替换而不是追加，
+    这样服务端的前缀缓存可以命中。
+    超出 token 预算或 max_turns 步时从最早的历史开始丢弃，只保留一条占位说明；
+    每次裁到上限的一半，两次裁剪之间前缀（包括占位说明）保持不变
+    """
+
+    def __init__(self, system_prompt: str, task: str, max_turns: Optional[int] = None):
+        self._head: List[Dict[str, Any]] = [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': f"任务: {task}"},
+        ]
+        self._head_tokens = sum(_estimate_tokens(m['content']) for m in self._head)
+        self._history: List[Dict[str, Any]] = []
+        self._history_tokens: List[int] = []
+        self._trimmed = 0
+        # Each step commits a reply + its result
+        self._max_entries = 2 * max_turns if max_turns else None
+
+    def commit(self, role: str, content: Any):
+        """Append a turn to the stable prefix"""
+        self._history.append({'role': role, 'content': content})
+        self._history_tokens.append(_estimate_tokens(content))
+
+    def build(self, dynamic: Any, token_budget: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Stable prefix + this step's page state"""
+        budget = None
+        if token_budget is not None:
+            budget = token_budget - self._head_tokens - _estimate_tokens(dynamic)
+        self._trim(budget)
+        
+        stub = []
+        if self._trimmed:
+            stub = [{'role': 'user', 'content': f"[... 已省略较早的 {self._trimmed} 条记录 ...]"}]
+        return self._head + stub + self._history + [{'role': 'user', 'content': dynamic}]
+
+    def _trim(self, budget: Optional[int]):
+        """Once the window or the budget is exceeded, drop the oldest turns down to half of it"""
+        total = sum(self._history_tokens)
+        over_window = self._max_entries is not None and len(self._history) > self._max_entries
+        over_budget = budget is not None and total > budget
+        if not (over_window or over_budget):
+            return
+        
+        # Trim in one block so the prefix stays byte-stable for the next few steps
+        drop = 0
+        if self._max_entries is not None:
+            drop = max(0, len(self._history) - self._max_entries // 2)
+            total -= sum(self._history_tokens[:drop])
+        if budget is not None:
+            while drop < len(self._history) and total > budget // 2:
+                total -= self._history_tokens[drop]
+                drop += 1
+        
+        # 剩下的历史从模型回复开始，和占位说明交替
+        while drop < len(self._history) and self._history[drop]['role'] != 'assistant':
+            drop += 1
+        
+        del self._history[:drop]
+        del self._history_tokens[:drop]
+        self._trimmed += drop
+
+
 class Browser4Zero:
 
     def __init__(self):
@@ -100,21 +466,27 @@ class Browser4Zero:
         self.model = os.getenv('OPENAI_MODEL', 'gpt-4o')
         self.headless = os.getenv('BROWSER_HEADLESS', 'false').lower() == 'true'
         self.max_steps = int(os.getenv('MAX_STEPS', '50'))
+        self.token_budget = int(os.getenv('TOKEN_BUDGET', '8000'))
+        self.max_history_turns = int(os.getenv('MAX_HISTORY_TURNS', '6'))
         self.screenshot_width = int(os.getenv('SCREENSHOT_WIDTH', '1280'))
-        self.navigation_timeout = int(os.getenv('NAVIGATION_TIMEOUT', '30000'))
-        self.action_timeout = int(os.getenv('ACTION_TIMEOUT', '10000'))
+        # Fail fast so the LLM can pick another action instead of stalling a step
+        self.navigation_timeout = int(os.getenv('NAVIGATION_TIMEOUT', '10000'))
+        self.action_timeout = int(os.getenv('ACTION_TIMEOUT', '5000'))
         
         if not self.api_key:
             raise ValueError("未设置 OPENAI_API_KEY")
         
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.api_base,
-            timeout=60
-        )
+        # Opt-in: skip patchright's per-call stack walk (only used for traces)
+        if os.getenv('PW_INSPECT_STACK', '1') == '0':
+            _install_light_stack_capture()
+        
+        self.client = _get_openai_client(self.api_base, self.api_key, 60)
+        # Turned off for good once the provider rejects stream=True
+        self._stream_ok = True
         
         # Runtime
         self.browser: Optional[Browser] = None
+        self.context: Optional[BrowserContext] = None
         self.page: Optional[Page] = None
         self.playwright = None
         
@@ -124,23 +496,77 @@ class Browser4Zero:
         self.vision_cooldown_until = 0
         
         # Detect loops
-        self.state_hashes: List[str] = []
+        self.state_hashes: Deque[int] = deque(maxlen=10)
         
         # Cache
         self.current_elements: List[Dict] = []
+        # Last perception result, reused while the page signature is unchanged
+        self._last_state: Optional[Dict[str, Any]] = None
+        # Bumped on every main-frame navigation / tab switch
+        self._nav_gen = 0
+        self._last_state_gen = -1
+        # selector -> locator, only valid for the navigation it was built in
+        self._locator_cache: Dict[str, Any] = {}
+        self._locator_gen = -1
         
         # Load helper
-        self.helper_js = self._load_helper_js()
+        self.helper_js = Browser4Zero._load_helper_js()
+        
+        # Action dispatch table: type -> bound handler
+        self._actions = {
+            'goto': self._act_goto,
+            'back': self._act_back,
+            'forward': self._act_forward,
+            'refresh': self._act_refresh,
+            'wait': self._act_wait,
+            'click': self._act_click,
+            'fill': self._act_fill,
+            'type': self._act_type,
+            'clear': self._act_clear,
+            'select': self._act_select,
+            'check': self._act_check,
+            'uncheck': self._act_uncheck,
+            'hover': self._act_hover,
+            'focus': self._act_focus,
+            'scrollTo': self._act_scroll_to,
+            'press': self._act_press,
+            'scroll': self._act_scroll,
+            'done': self._act_done,
+        }
+        
+        # Constant, built once so every run sends a byte-identical prefix
+        self._system_prompt = self._build_system_prompt()
     
-    def _load_helper_js(self) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _load_helper_js() -> str:
+        """Read page_helper.js once per process"""
         js_path = Path(__file__).parent / 'page_helper.js'
         if not js_path.exists():
             raise FileNotFoundError(f"Can't find page_helper.js: {js_path}")
         return js_path.read_text(encoding='utf-8')
     
+    async def ensure_started(self):
+        """Launches the browser once, later runs reuse it"""
+        if self.browser and self.browser.is_connected():
+            return
+        
+        print(f"  {Style.dim('Launching browser...')}")
+        await self._launch_browser()
+    
+    async def shutdown(self):
+        """Close the shared browser, call once when done with the agent"""
+        if self.browser:
+            await self.browser.close()
+            self.browser = None
+        if self.playwright:
+            await self.playwright.stop()
+            self.playwright = None
+    
     async def _launch_browser(self):
         """Launches the browser with patchright stealth configuration"""
-        self.playwright = await async_playwright().start()
+        if not self.playwright:
+            self.playwright = await async_playwright().start()
 
         # launch args
         launch_args = [
@@ -163,7 +589,9 @@ class Browser4Zero:
                 headless=self.headless,
                 args=launch_args
             )
-
+    
+    async def _new_context(self):
+        """Fresh context per task for isolated cookies/storage"""
         context = await self.browser.new_context(
             viewport={'width': self.screenshot_width, 'height': 720},
             user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.0',
@@ -175,8 +603,11 @@ class Browser4Zero:
         )
         context.set_default_timeout(self.action_timeout)
         context.set_default_navigation_timeout(self.navigation_timeout)
-
+        
+        self.context = context
         self.page = await context.new_page()
+        self.page.on('framenavigated', self._on_frame_navigated)
+        self._nav_gen += 1
         
         # 监听新页面打开，自动切换到新标签页
         context.on('page', self._on_new_page)
@@ -185,147 +616,73 @@ class Browser4Zero:
         """当有新标签页打开时，自动切换到新页面"""
         print(f"   {Style.label('New Tab', Style.CYAN)} Auto-switched")
         self.page = page
+        page.on('framenavigated', self._on_frame_navigated)
+        self._nav_gen += 1
         await page.wait_for_load_state('domcontentloaded')
-        await asyncio.sleep(0.5)
     
-    async def _ensure_helper(self) -> bool:
-        """Ensure the helper is there every loop"""
+    def _on_frame_navigated(self, frame):
+        """Only main-frame navigations invalidate the cached page state"""
+        if frame.parent_frame is None:
+            self._nav_gen += 1
+    
+    async def _probe_helper(self) -> bool:
+        """Check window.__AGENT__, a hung evaluate counts as missing"""
         try:
-            exists = await self.page.evaluate('typeof window.__AGENT__ !== "undefined"')
-            if exists:
-                return True
-        except:
-            pass
-        
+            return await asyncio.wait_for(
+                self.page.evaluate('typeof window.__AGENT__ !== "undefined"'),
+                timeout=1.0
+            )
+        except Exception:
+            return False
+    
+    async def _ensure_helper(self) -> bool:
+        """Inject helper + new-tab hijack into the isolated world of a new document"""
         # Inject
         for attempt in range(3):
             try:
-                await self.page.evaluate(self.helper_js)
-                
-                # 劫持所有可能打开新标签页的方式，强制在当前页打开
-                await self.page.evaluate('''
-                    (() => {
-                        // 1. 劫持 window.open，强制在当前窗口打开
-                        const originalOpen = window.open;
-                        window.open = function(url, target, features) {
-                            if (url) {
-                                window.location.href = url;
-                            }
-                            return window;
-                        };
-                        
-                        // 2. 劫持所有带 target 的链接，改为在当前页打开
-                        function fixTargetElements(root) {
-                            // 处理链接
-                            root.querySelectorAll && root.querySelectorAll('a[target]').forEach(el => {
-                                const original = el.getAttribute('target');
-                                if (original && !['_self', '_top'].includes(original)) {
-                                    el.removeAttribute('target');
-                                    el.setAttribute('data-original-target', original);
-                                }
-                            });
-                            
-                            // 处理表单
-                            root.querySelectorAll && root.querySelectorAll('form[target]').forEach(el => {
-                                const original = el.getAttribute('target');
-                                if (original && !['_self', '_top'].includes(original)) {
-                                    el.removeAttribute('target');
-                                    el.setAttribute('data-original-target', original);
-                                }
-                            });
-                            
-                            // 处理 base 标签的 target
-                            const base = document.querySelector('base[target]');
-                            if (base) {
-                                base.removeAttribute('target');
-                            }
-                        }
-                        
-                        // 3. 监听点击事件，拦截新窗口打开
-                        document.addEventListener('click', (e) => {
-                            const el = e.target.closest('a[target]');
-                            if (el) {
-                                const target = el.getAttribute('target');
-                                if (target && !['_self', '_top'].includes(target)) {
-                                    e.preventDefault();
-                                    const href = el.getAttribute('href');
-                                    if (href) {
-                                        window.location.href = href;
-                                    }
-                                }
-                            }
-                        }, true);
-                        
-                        // 4. 劫持表单提交，防止新窗口
-                        document.addEventListener('submit', (e) => {
-                            const form = e.target;
-                            const target = form.getAttribute('target');
-                            if (target && !['_self', '_top'].includes(target)) {
-                                form.removeAttribute('target');
-                            }
-                        }, true);
-                        
-                        // 5. 处理当前页面已有的元素
-                        fixTargetElements(document);
-                        
-                        // 6. 监听新添加的元素
-                        const observer = new MutationObserver(mutations => {
-                            mutations.forEach(mutation => {
-                                mutation.addedNodes.forEach(node => {
-                                    if (node.nodeType === Node.ELEMENT_NODE) {
-                                        fixTargetElements(node);
-                                        if (node.tagName === 'BASE' && node.target) {
-                                            node.removeAttribute('target');
-                                        }
-                                    }
-                                });
-                            });
-                        });
-                        observer.observe(document.documentElement, { childList: true, subtree: true });
-                        
-                        // 7. 劫持其他打开新窗口的方式
-                        // 防止使用 <area target="...">
-                        if (window.HTMLAreaElement) {
-                            const areaDesc = Object.getOwnPropertyDescriptor(HTMLAreaElement.prototype, 'target');
-                            if (areaDesc) {
-                                Object.defineProperty(HTMLAreaElement.prototype, 'target', {
-                                    get: areaDesc.get,
-                                    set: function(val) {
-                                        if (val && !['_self', '_top'].includes(val)) {
-                                            val = '_self';
-                                        }
-                                        return areaDesc.set.call(this, val);
-                                    }
-                                });
-                            }
-                        }
-                    })();
-                ''')
-                
-                exists = await self.page.evaluate('typeof window.__AGENT__ !== "undefined"')
-                if exists:
-                    return True
-            except Exception as e:
+                await asyncio.wait_for(
+                    self.page.evaluate(self.helper_js + '\n' + _TARGET_HIJACK_JS),
+                    timeout=1.0
+                )
+            except Exception:
                 if attempt < 2:
-                    await asyncio.sleep(0.3)
+                    await asyncio.sleep(0.25 * 2 ** attempt)
+                continue
+            
+            # Injected, only re-probe instead of injecting everything again
+            for _ in range(3):
+                if await self._probe_helper():
+                    return True
+                await asyncio.sleep(0.05)
         
         return False
     
-    async def _wait_for_stable(self, timeout_ms: int = 2000):
-        """Wait until the page is stable"""
+    async def _wait_for_nav(self, timeout_ms: int = 2000):
+        """After a navigation (already at domcontentloaded): let the network settle"""
         try:
             await self.page.wait_for_load_state('networkidle', timeout=timeout_ms)
+        except:
+            # Never went idle (polling, websockets...), the DOM is there already
+            pass
+    
+    async def _wait_after_input(self, nav_gen: int):
+        """After click/press: only wait when it actually started a navigation"""
+        if self._nav_gen != nav_gen:
+            await self._wait_for_nav()
+            return
+        try:
+            if await self.page.evaluate('document.readyState') != 'complete':
+                await self.page.wait_for_load_state('load', timeout=2000)
         except:
             pass
-        await asyncio.sleep(0.3)
     
     async def _safe_goto(self, url: str) -> Dict[str, Any]:
         """Go to page"""
-        print(f"   {Style.label('URL', Style.BLUE)} {Style.dim(url[:100])}...")
+        print(f"   {Style.LBL_URL} {Style.dim(url[:100])}...")
         
         try:
             await self.page.goto(url, wait_until='domcontentloaded')
-            await self._wait_for_stable()
+            await self._wait_for_nav()
             return {'success': True, 'message': f'已导航到 {url[:50]}'}
         except PlaywrightTimeout:
             # Partially loaded
@@ -336,18 +693,40 @@ class Browser4Zero:
     
     async def _get_page_state(self, mark: bool = True) -> Dict[str, Any]:
         """Get the state of the page"""
-        # make sure helper is there
-        if not await self._ensure_helper():
-            return {
-                'url': self.page.url,
-                'title': await self.page.title(),
-                'elements': [],
-                'pageText': '',
-                'error': 'Helper 注入失败'
-            }
+        # Nothing happened since the last read (e.g. a wait step or a failed
+        # LLM call): skip the whole perception if the page did not change either.
+        # After a navigation the cache is stale anyway, so don't even ask
+        if self._last_state is not None and self._last_state_gen == self._nav_gen:
+            try:
+                sig = await self.page.evaluate('window.__AGENT__ ? window.__AGENT__.signature() : null')
+            except:
+                sig = None
+            if sig is not None and sig == self._last_state.get('signature'):
+                return self._last_state
+        
+        take_shot = self.vision_enabled and self.vision_fail_count < 3
+        
+        # analyze + getReadableText + mark in one round trip
+        # With vision on, text is read alongside the screenshot below,
+        # and the call resolves once the marks are painted
+        capture_js = '([limit, mark, paint, elems]) => window.__AGENT__ ? window.__AGENT__.captureState(limit, mark, paint, elems) : null'
+        capture_args = [0 if take_shot else _TEXT_LIMIT, mark, take_shot, _ELEMENT_LIMIT]
         
         try:
-            state = await self.page.evaluate('window.__AGENT__.analyze()')
+            state = await self.page.evaluate(capture_js, capture_args)
+            
+            # New document: helper not injected yet (stays in the isolated world,
+            # invisible to page scripts), inject once and retry
+            if state is None:
+                if not await self._ensure_helper():
+                    return {
+                        'url': self.page.url,
+                        'title': await self.page.title(),
+                        'elements': [],
+                        'pageText': '',
+                        'error': 'Helper 注入失败'
+                    }
+                state = await self.page.evaluate(capture_js, capture_args)
         except Exception as e:
             return {
                 'url': self.page.url,
@@ -359,54 +738,38 @@ class Browser4Zero:
         
         # Cache the elements
         self.current_elements = state.get('elements', [])
+        nav_gen = self._nav_gen
         
-        # Mark
-        if mark and self.current_elements:
-            try:
-                await self.page.evaluate('window.__AGENT__.mark()')
-                await asyncio.sleep(0.2)
-            except:
-                pass
-        
-        # Screenshot
+        # Screenshot || text
         state['screenshot'] = None
-        if self.vision_enabled and self.vision_fail_count < 3:
-            try:
-                state['screenshot'] = await self._take_screenshot()
-                self.vision_fail_count = 0
-            except Exception as e:
+        if take_shot:
+            shot, text = await asyncio.gather(
+                self._take_screenshot(),
+                self.page.evaluate('(limit) => window.__AGENT__.getReadableText(limit)', _TEXT_LIMIT),
+                return_exceptions=True
+            )
+            
+            if isinstance(shot, Exception):
                 self.vision_fail_count += 1
-                print(f"   {Style.label('Warn', Style.YELLOW)} Screenshot failed ({self.vision_fail_count}/3): {Style.dim(str(e)[:50])}")
-        
-        # get text
-        try:
-            state['pageText'] = await self.page.evaluate('window.__AGENT__.getReadableText(5000)')
-        except:
-            state['pageText'] = ''
-        
-        # remove mark
-        if mark:
-            try:
-                await self.page.evaluate('window.__AGENT__.unmark()')
-            except:
-                pass
+                print(f"   {Style.label('Warn', Style.YELLOW)} Screenshot failed ({self.vision_fail_count}/3): {Style.dim(str(shot)[:50])}")
+            else:
+                state['screenshot'] = shot
+                self.vision_fail_count = 0
+            
+            state['pageText'] = '' if isinstance(text, Exception) else text
         
+        # Marks stay up until the next captureState() replaces them, which
+        # saves an unmark round trip per step (they ignore pointer events)
+        self._last_state = state
+        self._last_state_gen = nav_gen
         return state
     
-    async def _take_screenshot(self) -> str:
-        """Screenshot and zoom"""
-        data = await self.page.screenshot(type='jpeg', quality=60)
-        img = Image.open(BytesIO(data))
-        
-        # Zoom
-        max_dim = 1024
-        if max(img.size) > max_dim:
-            ratio = max_dim / max(img.size)
-            img = img.resize((int(img.width * ratio), int(img.height * ratio)), Image.Resampling.LANCZOS)
-        
-        buf = BytesIO()
-        img.convert('RGB').save(buf, format='JPEG', quality=50, optimize=True)
-        return base64.b64encode(buf.getvalue()).decode()
+    async def _take_screenshot(self) -> bytes:
+        """Screenshot as raw JPEG bytes, re-encoded with PIL only when too large"""
+        data = await self.page.screenshot(type='jpeg', quality=40, full_page=False)
+        if len(data) <= _SCREENSHOT_MAX_BYTES:
+            return data
+        return _downscale_jpeg(data)
     
     def _get_element_desc(self, index: int) -> str:
         """Gets a natural element description"""
@@ -422,7 +785,7 @@ class Browser4Zero:
             desc += f' "{text}"'
         return desc
     
-    async def _get_element_locator(self, index: int):
+    def _get_element_locator(self, index: int):
         """Get element locator with playwright"""
         if index < 1 or index > len(self.current_elements):
             return None
@@ -433,232 +796,195 @@ class Browser4Zero:
         if not selector:
             return None
         
-        try:
-            locator = self.page.locator(selector).first
-            # Check if it actually exists
-            if await locator.count() > 0:
-                return locator
-        except:
-            pass
+        # Locators are lazy and bound to the page, drop them once it navigated
+        if self._locator_gen != self._nav_gen:
+            self._locator_cache.clear()
+            self._locator_gen = self._nav_gen
         
-        return None
+        locator = self._locator_cache.get(selector)
+        if locator is None:
+            locator = self.page.locator(selector).first
+            self._locator_cache[selector] = locator
+        return locator
     
     async def _execute_action(self, action: Dict) -> Dict[str, Any]:
         """Execute actions"""
         action_type = action.get('type')
-        index = action.get('index')
-        value = action.get('value', '')
+        handler = self._actions.get(action_type) if isinstance(action_type, str) else None
+        if not handler:
+            return {'success': False, 'message': f'未知操作: {action_type}'}
         
         try:
-            # === Nav stuff ===
-            if action_type == 'goto':
-                url = action.get('url', '')
-                if not url:
-                    return {'success': False, 'message': '缺少 url 参数'}
-                return await self._safe_goto(url)
-            
-            elif action_type == 'back':
-                await self.page.go_back(wait_until='domcontentloaded')
-                await self._wait_for_stable()
-                return {'success': True, 'message': '已后退'}
-            
-            elif action_type == 'forward':
-                await self.page.go_forward(wait_until='domcontentloaded')
-                await self._wait_for_stable()
-                return {'success': True, 'message': '已前进'}
-            
-            elif action_type == 'refresh':
-                await self.page.reload(wait_until='domcontentloaded')
-                await self._wait_for_stable()
-                return {'success': True, 'message': '已刷新'}
-            
-            elif action_type == 'wait':
-                seconds = min(action.get('seconds', 2), 10)
-                await asyncio.sleep(seconds)
-                return {'success': True, 'message': f'已等待 {seconds} 秒'}
-            
-            # === Elemnt interactions ===
-            elif action_type == 'click':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.scroll_into_view_if_needed()
-                await locator.click(timeout=self.action_timeout)
-                await self._wait_for_stable()
-                return {'success': True, 'message': f'已点击 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'fill':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.scroll_into_view_if_needed()
-                await locator.fill(value, timeout=self.action_timeout)
-                return {'success': True, 'message': f'已输入到 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'type':
-                # Type one character at a time
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.scroll_into_view_if_needed()
-                await locator.click()
-                await locator.press_sequentially(value, delay=50)
-                return {'success': True, 'message': f'已键入到 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'clear':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.clear()
-                return {'success': True, 'message': f'已清空 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'select':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.select_option(label=value, timeout=self.action_timeout)
-                return {'success': True, 'message': f'已选择 "{value}"'}
-            
-            elif action_type == 'check':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.check(timeout=self.action_timeout)
-                return {'success': True, 'message': f'已勾选 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'uncheck':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.uncheck(timeout=self.action_timeout)
-                return {'success': True, 'message': f'已取消勾选 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'hover':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.hover(timeout=self.action_timeout)
-                return {'success': True, 'message': f'已悬停在 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'focus':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.focus()
-                return {'success': True, 'message': f'已聚焦 {self._get_element_desc(index)}'}
-            
-            elif action_type == 'scrollTo':
-                locator = await self._get_element_locator(index)
-                if not locator:
-                    return {'success': False, 'message': f'元素 {index} 不存在'}
-                
-                await locator.scroll_into_view_if_needed()
-                return {'success': True, 'message': f'已滚动到 {self._get_element_desc(index)}'}
-            
-            # === Global actions ===
-            elif action_type == 'press':
-                key = action.get('key', 'Enter')
-                await self.page.keyboard.press(key)
-                await self._wait_for_stable()
-                return {'success': True, 'message': f'已按 {key}'}
-            
-            elif action_type == 'scroll':
-                direction = action.get('direction', 'down')
-                amount = action.get('amount', 500)
-                
-                if direction == 'down':
-                    await self.page.mouse.wheel(0, amount)
-                elif direction == 'up':
-                    await self.page.mouse.wheel(0, -amount)
-                elif direction == 'right':
-                    await self.page.mouse.wheel(amount, 0)
-                elif direction == 'left':
-                    await self.page.mouse.wheel(-amount, 0)
-                
-                await asyncio.sleep(0.3)
-                return {'success': True, 'message': f'已向{direction}滚动'}
-            
-            elif action_type == 'done':
-                result = action.get('result', '任务完成')
-                return {'success': True, 'done': True, 'result': result}
-            
-            else:
-                return {'success': False, 'message': f'未知操作: {action_type}'}
-        
+            return await handler(action)
         except PlaywrightTimeout:
             return {'success': False, 'message': f'操作超时: {action_type}'}
         except Exception as e:
             return {'success': False, 'message': f'操作失败: {str(e)[:100]}'}
     
-    def _compute_state_hash(self, state: Dict) -> str:
-        """Compute hask for loop detection"""
-        key_data = {
-            'url': state.get('url', ''),
-            'element_count': len(state.get('elements', [])),
-            'text_hash': hashlib.md5(state.get('pageText', '')[:500].encode()).hexdigest()[:8]
-        }
-        return hashlib.md5(json.dumps(key_data).encode()).hexdigest()[:16]
+    # === Nav stuff ===
+    async def _act_goto(self, action: Dict) -> Dict[str, Any]:
+        url = action.get('url', '')
+        if not url:
+            return {'success': False, 'message': '缺少 url 参数'}
+        return await self._safe_goto(url)
     
-    def _detect_loop(self, current_hash: str) -> Optional[str]:
+    async def _act_back(self, action: Dict) -> Dict[str, Any]:
+        await self.page.go_back(wait_until='domcontentloaded')
+        await self._wait_for_nav()
+        return {'success': True, 'message': '已后退'}
+    
+    async def _act_forward(self, action: Dict) -> Dict[str, Any]:
+        await self.page.go_forward(wait_until='domcontentloaded')
+        await self._wait_for_nav()
+        return {'success': True, 'message': '已前进'}
+    
+    async def _act_refresh(self, action: Dict) -> Dict[str, Any]:
+        await self.page.reload(wait_until='domcontentloaded')
+        await self._wait_for_nav()
+        return {'success': True, 'message': '已刷新'}
+    
+    async def _act_wait(self, action: Dict) -> Dict[str, Any]:
+        seconds = min(action.get('seconds', 2), 10)
+        await asyncio.sleep(seconds)
+        return {'success': True, 'message': f'已等待 {seconds} 秒'}
+    
+    # === Elemnt interactions ===
+    @_with_locator
+    async def _act_click(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.scroll_into_view_if_needed()
+        nav_gen = self._nav_gen
+        await locator.click(timeout=self.action_timeout)
+        await self._wait_after_input(nav_gen)
+        return {'success': True, 'message': f'已点击 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_fill(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        value = action.get('value', '')
+        await locator.scroll_into_view_if_needed()
+        await locator.fill(value, timeout=self.action_timeout)
+        return {'success': True, 'message': f'已输入到 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_type(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        value = action.get('value', '')
+        await locator.scroll_into_view_if_needed()
+        await locator.click()
+        # Real (trusted) key events, no artificial per-key delay
+        await locator.press_sequentially(value)
+        return {'success': True, 'message': f'已键入到 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_clear(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.clear()
+        return {'success': True, 'message': f'已清空 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_select(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        value = action.get('value', '')
+        await locator.select_option(label=value, timeout=self.action_timeout)
+        return {'success': True, 'message': f'已选择 "{value}"'}
+    
+    @_with_locator
+    async def _act_check(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.check(timeout=self.action_timeout)
+        return {'success': True, 'message': f'已勾选 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_uncheck(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.uncheck(timeout=self.action_timeout)
+        return {'success': True, 'message': f'已取消勾选 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_hover(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.hover(timeout=self.action_timeout)
+        return {'success': True, 'message': f'已悬停在 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_focus(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.focus()
+        return {'success': True, 'message': f'已聚焦 {self._get_element_desc(index)}'}
+    
+    @_with_locator
+    async def _act_scroll_to(self, action: Dict, index: int, locator) -> Dict[str, Any]:
+        await locator.scroll_into_view_if_needed()
+        return {'success': True, 'message': f'已滚动到 {self._get_element_desc(index)}'}
+    
+    # === Global actions ===
+    async def _act_press(self, action: Dict) -> Dict[str, Any]:
+        key = action.get('key', 'Enter')
+        nav_gen = self._nav_gen
+        if key.endswith('Enter'):
+            # Unlike click, press doesn't wait for the navigation it starts
+            # (form submit), give it a moment to commit before looking
+            try:
+                async with self.page.expect_navigation(wait_until='commit', timeout=2000):
+                    await self.page.keyboard.press(key)
+            except PlaywrightTimeout:
+                pass
+        else:
+            await self.page.keyboard.press(key)
+        await self._wait_after_input(nav_gen)
+        return {'success': True, 'message': f'已按 {key}'}
+    
+    async def _act_scroll(self, action: Dict) -> Dict[str, Any]:
+        direction = action.get('direction', 'down')
+        amount = action.get('amount', 500)
+        
+        if direction == 'down':
+            await self.page.mouse.wheel(0, amount)
+        elif direction == 'up':
+            await self.page.mouse.wheel(0, -amount)
+        elif direction == 'right':
+            await self.page.mouse.wheel(amount, 0)
+        elif direction == 'left':
+            await self.page.mouse.wheel(-amount, 0)
+        
+        try:
+            await self.page.evaluate('window.__AGENT__.waitForScrollIdle(500)')
+        except:
+            await asyncio.sleep(0.3)
+        return {'success': True, 'message': f'已向{direction}滚动'}
+    
+    async def _act_done(self, action: Dict) -> Dict[str, Any]:
+        result = action.get('result', '任务完成')
+        return {'success': True, 'done': True, 'result': result}
+    
+    def _compute_state_hash(self, state: Dict) -> int:
+        """Compute hash for loop detection"""
+        # 只用于循环检测，不需要加密强度；单次 blake2b，不再经过 json.dumps
+        h = hashlib.blake2b(digest_size=8)
+        h.update(state.get('url', '').encode())
+        h.update(state.get('elementCount', len(state.get('elements', []))).to_bytes(4, 'little'))
+        h.update(state.get('pageText', '')[:500].encode())
+        return int.from_bytes(h.digest(), 'little')
+    
+    def _detect_loop(self, current_hash: int) -> Optional[str]:
         """Detects loop & reminds the agent"""
+        # deque(maxlen=10) only keeps recent ones
         self.state_hashes.append(current_hash)
         
-        # Only keep recent ones
-        if len(self.state_hashes) > 10:
-            self.state_hashes = self.state_hashes[-10:]
-        
+        # 前几步不检测 (warm-up)
+        if len(self.state_hashes) < 5:
+            return None
+
         # Check for duplicate actions.
-        if len(self.state_hashes) >= 5:
-            if self.state_hashes[-1] == self.state_hashes[-2] == self.state_hashes[-3]:
-                return "LOOP DETECTED: 连续3步页面状态完全相同！你必须尝试本质不同的操作（换URL、换策略、或用done结束）。如果这是误判（例如操作确实需要重复执行），请忽略并继续执行。"
+        a, b, c = self.state_hashes[-1], self.state_hashes[-2], self.state_hashes[-3]
+        if a == b == c:
+            return "LOOP DETECTED: 连续3步页面状态完全相同！你必须尝试本质不同的操作（换URL、换策略、或用done结束）。如果这是误判（例如操作确实需要重复执行），请忽略并继续执行。"
         
         return None
     
-    def _format_elements(self, elements: List[Dict]) -> str:
-        """Elements list"""
+    def _format_elements(self, elements: List[Dict], total: Optional[int] = None, limit: int = _ELEMENT_LIMIT) -> str:
+        """Elements list, lines are pre-formatted by page_helper.js"""
         if not elements:
             return "（无可交互元素）"
         
-        lines = []
-        for el in elements[:40]:
-            idx = el['index']
-            tag = el['tag']
-            text = el.get('text', '')[:35]
-            rect = el.get('rect', {})
-            state = el.get('state', {})
-            
-            line = f"[{idx}] {tag}"
-            if text:
-                line += f' "{text}"'
-            
-            # Location
-            if rect:
-                line += f" @({rect.get('x',0)},{rect.get('y',0)})"
-            
-            # State
-            state_parts = []
-            if state.get('value'):
-                state_parts.append(f'value="{state["value"][:15]}"')
-            if state.get('checked'):
-                state_parts.append('[x]')
-            if state.get('disabled'):
-                state_parts.append('disabled')
-            if state_parts:
-                line += f" [{', '.join(state_parts)}]"
-            
-            lines.append(line)
+        lines = [el['display'] for el in elements[:limit]]
         
-        if len(elements) > 100:
-            lines.append(f"... 还有 {len(elements) - 100} 个元素")
+        # The helper already cut the list, total is the real element count
+        total = max(total or 0, len(elements))
+        if total > limit:
+            lines.append(f"... 还有 {total - limit} 个元素")
         
         return '\n'.join(lines)
     
@@ -719,11 +1045,10 @@ class Browser4Zero:
 表单：逐个 fill 字段 → click 提交按钮
 弹窗：优先找"关闭""×""接受"按钮点击"""
 
-    def _build_user_message(self, state: Dict, task: str, step: int, loop_warning: Optional[str] = None) -> Any:
-        """Build user message"""
+    def _build_user_message(self, state: Dict, step: int, loop_warning: Optional[str] = None) -> Any:
+        """Build this step's page state message, the task lives in the stable prefix"""
         parts = [
             f"## 步骤 {step}",
-            f"任务: {task}",
             "",
             f"URL: {state.get('url', 'N/A')}",
             f"标题: {state.get('title', 'N/A')}",
@@ -736,11 +1061,13 @@ class Browser4Zero:
         if state.get('error'):
             parts.append(f"\n[Error] {state['error']}")
         
-        parts.append(f"\n### 元素列表 ({len(state.get('elements', []))}个)")
-        parts.append(self._format_elements(state.get('elements', [])))
+        elements = state.get('elements', [])
+        total = state.get('elementCount', len(elements))
+        parts.append(f"\n### 元素列表 ({total}个)")
+        parts.append(self._format_elements(elements, total))
         
         parts.append("\n### 页面文本")
-        text = state.get('pageText', '')[:800]
+        text = state.get('pageText', '')[:_TEXT_LIMIT]
         parts.append(text if text else "(无文本)")
         
         parts.append("\n---\n请分析并执行下一步。")
@@ -749,37 +1076,98 @@ class Browser4Zero:
         
         # With screenshot
         if state.get('screenshot'):
+            # base64 only at serialization time
+            image_url = (b'data:image/jpeg;base64,' + base64.b64encode(state['screenshot'])).decode('ascii')
             return [
-                {'type': 'image_url', 'image_url': {'url': f"data:image/jpeg;base64,{state['screenshot']}", 'detail': 'low'}},
+                {'type': 'image_url', 'image_url': {'url': image_url, 'detail': 'low'}},
                 {'type': 'text', 'text': text_content}
             ]
         return text_content
     
+    async def _complete(self, messages: List[Dict]) -> Tuple[str, bool]:
+        """Reply text + whether the thought was already echoed while streaming"""
+        if self._stream_ok:
+            try:
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.5,
+                    max_tokens=600,
+                    stream=True
+                )
+            except (BadRequestError, UnprocessableEntityError):
+                # Provider doesn't do streaming, plain calls from now on
+                self._stream_ok = False
+            else:
+                return await self._consume_stream(stream)
+        
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=0.5,
+            max_tokens=600
+        )
+        return response.choices[0].message.content or '', False
+    
+    async def _consume_stream(self, stream) -> Tuple[str, bool]:
+        """Collect a streamed reply, printing the thought as it arrives"""
+        content = ''
+        thought_at = None
+        shown = 0
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            content += delta
+            
+            if shown >= _THOUGHT_ECHO_LIMIT:
+                continue
+            if thought_at is None:
+                match = _THOUGHT_START.search(content)
+                if not match:
+                    continue
+                thought_at = match.end()
+                sys.stdout.write(f"\n  {Style.LBL_THINK} ")
+            thought = _partial_json_string(content[thought_at:])[:_THOUGHT_ECHO_LIMIT]
+            if len(thought) > shown:
+                sys.stdout.write(Style.dim(thought[shown:].replace('\n', ' ')))
+                sys.stdout.flush()
+                shown = len(thought)
+        
+        if thought_at is not None:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+        return content, thought_at is not None
+    
     async def _call_llm(self, messages: List[Dict]) -> Dict:
         """Call LLM"""
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.5,
-                max_tokens=600
-            )
-            
-            content = response.choices[0].message.content.strip()
-            
-            # Decode JSON
-            content = re.sub(r'^```json\s*', '', content)
-            content = re.sub(r'\s*```$', '', content)
+            content, echoed = await self._complete(messages)
+            content = content.strip()
             
-            match = re.search(r'\{.*\}', content, re.DOTALL)
-            if match:
-                content = match.group(0)
+            # Decode JSON, bare object (the usual case) needs no regex at all
+            if not (content.startswith('{') and content.endswith('}')):
+                if content.startswith('```'):
+                    content = _JSON_FENCE_START.sub('', content, 1)
+                    content = _JSON_FENCE_END.sub('', content, 1)
+                
+                match = _JSON_OBJ.search(content)
+                if match:
+                    content = match.group(0)
             
+            # stdlib on purpose: more lenient than orjson with what models emit (NaN etc.)
             data = json.loads(content)
             
             if 'action' not in data:
                 raise ValueError("Missing action")
             
+            # 思考 (streamed replies have shown it already)
+            if not echoed:
+                thought = str(data.get('thought', ''))
+                _write_lines([f"\n  {Style.LBL_THINK} {Style.dim(thought[:_THOUGHT_ECHO_LIMIT])}"])
+            
             return data
         
         except json.JSONDecodeError as e:
@@ -792,8 +1180,8 @@ class Browser4Zero:
         """Run the task"""
         try:
             print(Style.header('Browser4Zero', Style.CYAN))
-            print(f"  {Style.dim('Launching browser...')}")
-            await self._launch_browser()
+            await self.ensure_started()
+            await self._new_context()
             
             if start_url:
                 result = await self._safe_goto(start_url)
@@ -803,82 +1191,110 @@ class Browser4Zero:
             print(f"\n{Style.label('Task', Style.MAGENTA)} {task}\n")
             
             # Messages
-            messages = [{'role': 'system', 'content': self._build_system_prompt()}]
+            prompt = PromptManager(self._system_prompt, task, self.max_history_turns)
             
-            self.state_hashes = []
+            self.state_hashes.clear()
+            self._last_state = None
             
             for step in range(1, self.max_steps + 1):
-                # 步骤显示
-                print(Style.step(step))
-                
                 # Get state
                 state = await self._get_page_state()
                 
-                # 状态栏
+                # 步骤显示 + 状态栏，输出按块攒起来一次写出
                 url = state.get('url', 'N/A')[:65]
-                elems = len(state.get('elements', []))
-                print(f"  {Style.label('URL', Style.BLUE)} {url}")
-                print(f"  {Style.label('Elements', Style.GREEN)} {elems}")
+                elems = state.get('elementCount', len(state.get('elements', [])))
+                out = [
+                    Style.step(step),
+                    f"  {Style.LBL_URL} {url}",
+                    f"  {Style.LBL_ELEMS} {elems}",
+                ]
                 
                 # Loop detection
                 state_hash = self._compute_state_hash(state)
                 loop_warning = self._detect_loop(state_hash)
                 if loop_warning:
-                    print(f"\n  {Style.label('Warning', Style.YELLOW)} {loop_warning}")
+                    out.append(f"\n  {Style.LBL_WARNING} {loop_warning}")
+                
+                # Flush before the LLM call, the longest wait of the step
+                _write_lines(out)
+                out = []
                 
                 # Build messages
-                user_msg = self._build_user_message(state, task, step, loop_warning)
-                messages.append({'role': 'user', 'content': user_msg})
+                user_msg = self._build_user_message(state, step, loop_warning)
                 
                 # LLM
+                response = None
                 try:
-                    response = await self._call_llm(messages)
-                    thought = response.get('thought', '')
+                    response = await self._call_llm(prompt.build(user_msg, self.token_budget))
                     action = response.get('action', {})
                     
-                    # 思考
-                    print(f"\n  {Style.label('Think', Style.MAGENTA)} {Style.dim(thought[:70])}")
-                    
                     # 操作
                     action_type = action.get('type', 'unknown')
-                    action_json = json.dumps(action, ensure_ascii=False)
-                    print(f"  {Style.action(action_type, action_json)}")
+                    action_json = _dumps(action)
+                    out.append(f"  {Style.action(action_type, action_json)}")
                     
                 except Exception as e:
-                    print(f"\n  {Style.label('Error', Style.RED)} LLM call failed: {e}")
-                    # Append model response AND system note
-                    messages.append({'role': 'assistant', 'content': response.get('content', "")})
-                    messages.append({'role': 'user', 'content': '错误：你的上一次响应不是合法的 JSON 或缺少 "action" 字段，操作未被执行。请重新输出仅包含合法、符合要求的 JSON 回复，不要附加任何多余文本；若反复失败，请换一种方法完成任务。'})
+                    _write_lines([f"\n  {Style.LBL_ERROR} LLM call failed: {e}"])
+                    # Append model response (if it got that far) AND system note
+                    if isinstance(response, dict):
+                        prompt.commit('assistant', _dumps(response))
+                    prompt.commit('user', '错误：你的上一次响应不是合法的 JSON 或缺少 "action" 字段，操作未被执行。请重新输出仅包含合法、符合要求的 JSON 回复，不要附加任何多余文本；若反复失败，请换一种方法完成任务。')
                     continue
                 
-                messages.append({'role': 'assistant', 'content': json.dumps(response, ensure_ascii=False)})
+                prompt.commit('assistant', _dumps(response))
                 
                 result = await self._execute_action(action)
+                if action_type != 'wait':
+                    self._last_state = None
                 
                 # 结果显示
                 success = result.get('success', False)
-                status_label = Style.label('OK', Style.GREEN) if success else Style.label('Fail', Style.RED)
+                status_label = Style.LBL_OK if success else Style.LBL_FAIL
                 msg = result.get('message', 'unknown')
-                print(f"  {status_label} {msg}")
+                out.append(f"  {status_label} {msg}")
                 
                 result_msg = f"Result: {result.get('message', 'unknown')}"
                 if not success:
                     result_msg = f"Failed: {result_msg}"
-                messages.append({'role': 'user', 'content': result_msg})
+                prompt.commit('user', result_msg)
                 
                 if result.get('done'):
                     final_result = result.get('result', 'Task completed')
-                    print(f"\n{Style.label('Done', Style.GREEN)} Step {step}")
-                    print(f"{final_result}")
+                    out.append(f"\n{Style.label('Done', Style.GREEN)} Step {step}")
+                    out.append(f"{final_result}")
+                    _write_lines(out)
                     return final_result
+                
+                _write_lines(out)
             
             return f"Max steps reached ({self.max_steps})"
         
         finally:
-            if self.browser:
-                await self.browser.close()
-            if self.playwright:
-                await self.playwright.stop()
+            if self.context:
+                await self.context.close()
+                self.context = None
+
+
+async def _ainput(prompt: str) -> str:
+    """input() on a daemon thread so the event loop keeps running while we wait"""
+    if not sys.stdin.isatty():
+        # Piped input is there already (or EOF), and a reader thread still
+        # blocked on a pipe can abort interpreter shutdown after Ctrl-C
+        return input(prompt)
+    
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, line)
+    
+    threading.Thread(target=read, daemon=True).start()
+    return await future
 
 
 async def main():
@@ -892,6 +1308,13 @@ async def main():
     args = parser.parse_args()
     agent = Browser4Zero()
     
+    try:
+        await _run_cli(agent, args)
+    finally:
+        await agent.shutdown()
+
+
+async def _run_cli(agent: Browser4Zero, args):
     if args.interactive or not args.task:
         # 欢迎界面
         print(Style.header('Browser4Zero', Style.CYAN))
@@ -902,7 +1325,7 @@ async def main():
         while True:
             try:
                 prompt = f"\n{Style.label('Input', Style.CYAN)} What to do? "
-                task = input(prompt).strip()
+                task = (await _ainput(prompt)).strip()
                 if task.lower() in ['q', 'quit', 'exit']:
                     print(f"\n{Style.dim('Goodbye!')}")
                     break
@@ -910,11 +1333,12 @@ async def main():
                     continue
                 
                 url_prompt = f"{Style.label('Input', Style.CYAN)} Start URL (Enter to skip): "
-                url = input(url_prompt).strip() or None
+                url = (await _ainput(url_prompt)).strip() or None
                 
                 result = await agent.run(task, url)
                 
-            except KeyboardInterrupt:
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                # Ctrl-C under asyncio.run() cancels the main task instead
                 print(f"\n\n{Style.dim('Interrupted. Goodbye!')}")
                 break
             except Exception as e:
@@ -922,9 +1346,17 @@ async def main():
                 import traceback
                 traceback.print_exc()
     else:
-        result = await agent.run(args.task, args.url)
+        try:
+            result = await agent.run(args.task, args.url)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print(f"\n\n{Style.dim('Interrupted. Goodbye!')}")
+            return
         print(f"\n{Style.label('Result', Style.GREEN)}\n{result}")
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # asyncio.run() re-raises it after main() has shut down cleanly
+        pass
\ No newline at end of file
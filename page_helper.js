@@ -50,18 +50,43 @@
                 }
             }, true);
             
-            // 5. 监听新元素
+            // 5. 监听新元素，50ms 内的变动合并处理
+            const seen = new WeakSet();
+            let pending = [];
+            let flushTimer = null;
+            function flushPending() {
+                flushTimer = null;
+                const nodes = pending;
+                pending = [];
+                for (const n of nodes) {
+                    // 有子元素的节点总是重新扫描（子树可能在脱离期间变过）
+                    if (!n.isConnected || (seen.has(n) && !n.firstElementChild)) continue;
+                    seen.add(n);
+                    if (n.tagName === 'BASE' && n.target) n.removeAttribute('target');
+                    if (n.matches && n.matches('a[target], form[target], area[target]')) {
+                        const t = n.getAttribute('target');
+                        if (t && !['_self', '_top'].includes(t)) {
+                            n.removeAttribute('target');
+                            n.setAttribute('data-original-target', t);
+                        }
+                    }
+                    if (n.firstElementChild) removeTargets(n);
+                }
+            }
             const observer = new MutationObserver(mutations => {
                 mutations.forEach(m => {
                     m.addedNodes.forEach(n => {
-                        if (n.nodeType === Node.ELEMENT_NODE) {
-                            removeTargets(n);
-                            if (n.tagName === 'BASE' && n.target) n.removeAttribute('target');
-                        }
+                        if (n.nodeType === Node.ELEMENT_NODE) pending.push(n);
                     });
+                    // 移除的节点可能被重新插入（SPA 重渲染、portal），到时要重新处理
+                    m.removedNodes.forEach(n => seen.delete(n));
                 });
+                if (pending.length && flushTimer === null) {
+                    flushTimer = setTimeout(flushPending, 50);
+                }
             });
-            observer.observe(document.documentElement, { childList: true, subtree: true });
+            // 作为 init script 运行时 documentElement 可能还不存在
+            observer.observe(document, { childList: true, subtree: true });
             
         } catch (e) {}
     }
@@ -166,6 +191,30 @@
     let elements = [];
     let overlays = new Map();
     let isMarked = false;
+    let mutationSeq = 0;
+
+    // DOM 变动计数（忽略我们自己的标注），用来判断页面是否变化
+    function isOwnMutation(m) {
+        const target = m.target;
+        if (target.nodeType === Node.ELEMENT_NODE && target.closest('.__agent_overlay__')) {
+            return true;
+        }
+        if (m.type !== 'childList') return false;
+        const nodes = [...m.addedNodes, ...m.removedNodes];
+        return nodes.length > 0 && nodes.every(n => n.classList && n.classList.contains('__agent_overlay__'));
+    }
+    try {
+        new MutationObserver(mutations => {
+            if (!mutations.every(isOwnMutation)) mutationSeq++;
+        }).observe(document, { childList: true, subtree: true, attributes: true, characterData: true });
+    } catch (e) {}
+
+    /**
+     * 页面状态签名：URL + DOM 变动计数 + 滚动位置
+     */
+    function signature() {
+        return [window.location.href, mutationSeq, Math.round(window.scrollX), Math.round(window.scrollY)];
+    }
 
     // 颜色池
     const COLORS = [
@@ -496,10 +545,30 @@
         return validElements;
     }
 
+    /**
+     * 生成发给 LLM 的单行描述：[index] 标签 "文本" @(x,y) [状态]
+     */
+    function formatElement(data, index) {
+        let line = `[${index}] ${data.tag}`;
+        const text = data.text.substring(0, 35);
+        if (text) line += ` "${text}"`;
+        line += ` @(${data.rect.x},${data.rect.y})`;
+
+        const parts = [];
+        const state = data.state;
+        if (state.value) parts.push(`value="${state.value.substring(0, 15)}"`);
+        if (state.checked) parts.push('[x]');
+        if (state.disabled) parts.push('disabled');
+        if (parts.length > 0) line += ` [${parts.join(', ')}]`;
+
+        return line;
+    }
+
     /**
      * 分析页面
+     * elementLimit > 0 时只返回（并标注）前 N 个元素，elementCount 为总数
      */
-    function analyze() {
+    function analyze(elementLimit = 0) {
         elements = collectInteractiveElements();
 
         // 按视觉位置排序：从上到下，从左到右
@@ -509,6 +578,11 @@
             return a.rect.x - b.rect.x;
         });
 
+        const elementCount = elements.length;
+        if (elementLimit > 0 && elementCount > elementLimit) {
+            elements = elements.slice(0, elementLimit);
+        }
+
         const result = {
             url: window.location.href,
             title: document.title,
@@ -528,10 +602,10 @@
                 tag: data.tag,
                 text: data.text.substring(0, 80),
                 rect: data.rect,
-                center: data.center,
-                actions: data.actions,
-                state: data.state
+                state: data.state,
+                display: formatElement(data, index + 1)
             })),
+            elementCount,
             focusedIndex: null
         };
 
@@ -577,6 +651,9 @@
             const tag = node.tagName.toLowerCase();
             if (skipTags.has(tag)) return;
 
+            // 跳过我们自己的标注
+            if (node.classList.contains('__agent_overlay__')) return;
+
             // 检查可见性
             try {
                 const style = window.getComputedStyle(node);
@@ -678,9 +755,85 @@
         isMarked = false;
     }
 
+    /**
+     * 一次性采集页面状态（分析 + 文本 + 标注），省掉多次往返
+     * 上一步的标注在这里通过 mark() 一并替换（没有新标注时直接清除），不需要单独 unmark
+     */
+    function captureState(textLimit = 5000, withMarks = true, waitPaint = false, elementLimit = 0) {
+        const result = analyze(elementLimit);
+        result.signature = signature();
+
+        // textLimit 为 0 时由调用方单独获取文本（例如与截图并行）
+        result.pageText = '';
+        if (textLimit > 0) {
+            try {
+                result.pageText = getReadableText(textLimit);
+            } catch (e) {}
+        }
+
+        result.marked = false;
+        if (withMarks && elements.length > 0) {
+            mark();
+            result.marked = true;
+        } else if (isMarked) {
+            // 不重新标注时清掉上一步的标注，免得残留的编号框指向空处
+            unmark();
+        }
+
+        // 需要截图时，等标注（或清除）真正绘制出来再返回
+        if (waitPaint) {
+            return nextPaint().then(() => result);
+        }
+
+        return result;
+    }
+
+    /**
+     * 等待下一次绘制完成（超时兜底，后台页面不触发 rAF）
+     */
+    function nextPaint(timeoutMs = 200) {
+        return new Promise(resolve => {
+            const timer = setTimeout(resolve, timeoutMs);
+            requestAnimationFrame(() => requestAnimationFrame(() => {
+                clearTimeout(timer);
+                resolve();
+            }));
+        });
+    }
+
+    /**
+     * 等待滚动停止：连续几帧位置不变即视为结束
+     */
+    function waitForScrollIdle(timeoutMs = 500) {
+        return new Promise(resolve => {
+            const timer = setTimeout(resolve, timeoutMs);
+            let lastX = window.scrollX;
+            let lastY = window.scrollY;
+            let stableFrames = 0;
+
+            function check() {
+                const x = window.scrollX;
+                const y = window.scrollY;
+                stableFrames = (x === lastX && y === lastY) ? stableFrames + 1 : 0;
+                lastX = x;
+                lastY = y;
+                if (stableFrames >= 3) {
+                    clearTimeout(timer);
+                    resolve();
+                    return;
+                }
+                requestAnimationFrame(check);
+            }
+            requestAnimationFrame(check);
+        });
+    }
+
     // 暴露 API
     const API = {
         analyze,
+        captureState,
+        waitForScrollIdle,
+        signature,
         mark,
         unmark,
         getSelector,
@@ -0,0 +1,36 @@
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+# agent.py exits on missing dependencies, skip instead
+for _mod in ('patchright', 'openai', 'dotenv', 'PIL', 'orjson'):
+    pytest.importorskip(_mod)
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import agent
+
+
+def _jpeg(size):
+    buf = BytesIO()
+    Image.new('RGB', size, 'white').save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def test_draft_decodes_landscape_at_reduced_size():
+    img = Image.open(BytesIO(_jpeg((2560, 1440))))
+    img.draft('RGB', agent._draft_size(img.size, 1024))
+    assert img.size == (1280, 720)
+
+
+def test_draft_size_keeps_aspect_ratio():
+    assert agent._draft_size((1280, 720), 1024) == (1024, 576)
+    assert agent._draft_size((720, 1280), 1024) == (576, 1024)
+
+
+def test_downscale_jpeg_fits_max_dim():
+    out = Image.open(BytesIO(agent._downscale_jpeg(_jpeg((2560, 1440)))))
+    assert out.size == (1024, 576)